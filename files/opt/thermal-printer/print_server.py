@@ -3,7 +3,10 @@
 Thermal Printer Server for ORGSTA T001
 """
 
-import base64
+import binascii
+import errno
+import gzip
+import hashlib
 import http.server
 import io
 import json
@@ -11,6 +14,7 @@ import os
 import random
 import socketserver
 import sys
+import threading
 import time
 import traceback
 from datetime import datetime
@@ -67,6 +71,10 @@ def dedupe(items):
 
 
 PORT = env_int("THERMAL_PORT", 8765)
+MAX_CONNECTIONS = max(1, env_int("THERMAL_MAX_CONNECTIONS", 32))
+IMAGE_WORKERS = max(1, env_int("THERMAL_IMAGE_WORKERS", 2))
+HTTP_TIMEOUT = env_float("THERMAL_HTTP_TIMEOUT", 30.0)
+LOG_REQUESTS = env_bool("THERMAL_LOG_REQUESTS", False)
 PRINTER_DPI = env_int("THERMAL_DPI", 203)
 GAP_MM = env_float("THERMAL_GAP_MM", 3.0)
 MM_PER_INCH = 25.4
@@ -74,6 +82,8 @@ MM_PER_INCH = 25.4
 # Label configuration for 4" x 6" labels
 LABEL_WIDTH_MM = env_float("THERMAL_LABEL_WIDTH_MM", 101.6)
 LABEL_HEIGHT_MM = env_float("THERMAL_LABEL_HEIGHT_MM", 152.4)
+LABEL_WIDTH_DOTS = round(LABEL_WIDTH_MM * PRINTER_DPI / MM_PER_INCH)
+LABEL_HEIGHT_DOTS = round(LABEL_HEIGHT_MM * PRINTER_DPI / MM_PER_INCH)
 X_OFFSET = env_int("THERMAL_X_OFFSET", 0)
 Y_OFFSET = env_int("THERMAL_Y_OFFSET", 0)
 
@@ -82,6 +92,12 @@ AUTO_TRIM_TOP_WHITESPACE = env_bool("THERMAL_AUTO_TRIM_TOP_WHITESPACE", False)
 WHITE_THRESHOLD = env_int("THERMAL_WHITE_THRESHOLD", 245)
 MAX_TOP_TRIM_PX = env_int("THERMAL_MAX_TOP_TRIM_PX", 80)
 HORIZONTAL_SHIFT_PX = env_int("THERMAL_HORIZONTAL_SHIFT_PX", -20)
+MAX_IMAGE_PIXELS = env_int("THERMAL_MAX_IMAGE_PIXELS", 2000 * 3000)
+
+# Precomputed point() tables so Pillow maps pixels without a Python callback.
+# Mode "1" output: 255 = white (no dot), 0 = black (printed dot).
+THRESHOLD_LUT = bytes(255 if p >= 128 else 0 for p in range(256))
+CONTENT_MASK_LUT = bytes(255 if p < WHITE_THRESHOLD else 0 for p in range(256))
 
 _env_candidates = os.getenv("THERMAL_DEVICE_CANDIDATES", "").replace(",", ":").split(":")
 PRINTER_DEVICE_CANDIDATES = dedupe(
@@ -89,6 +105,14 @@ PRINTER_DEVICE_CANDIDATES = dedupe(
     + [c.strip() for c in _env_candidates]
     + ["/dev/thermal-printer", "/dev/usb/lp0", "/dev/usb/lp1", "/dev/usb/lp2"]
 )
+# Hold the printer device open between jobs instead of reopening it per job.
+# usblp only allows one open at a time, so set 0 to free it for other tools.
+KEEP_DEVICE_OPEN = env_bool("THERMAL_KEEP_DEVICE_OPEN", True)
+# usblp blocks writes while the printer is out of paper or its cover is open;
+# jobs queued behind such a write give up with 503 printer_busy after this.
+PRINTER_BUSY_TIMEOUT = env_float("THERMAL_PRINTER_BUSY_TIMEOUT", 30.0)
+# Upper bound for a single device write; 0 writes each job in one call.
+PRINTER_WRITE_CHUNK = env_int("THERMAL_WRITE_CHUNK_BYTES", 4096)
 
 
 def log_event(level, message, **fields):
@@ -126,6 +150,7 @@ def printer_health():
             "auto_trim_top_whitespace": AUTO_TRIM_TOP_WHITESPACE,
             "white_threshold": WHITE_THRESHOLD,
             "max_top_trim_px": MAX_TOP_TRIM_PX,
+            "max_image_pixels": MAX_IMAGE_PIXELS,
         },
     }
 
@@ -204,6 +229,45 @@ def parse_rewind_request(path, body):
     }
 
 
+RAW_IMAGE_CONTENT_TYPES = ("image/", "application/octet-stream")
+IMAGE_READ_CHUNK = 64 * 1024
+_BASE64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+_BASE64_JUNK = bytes(sorted(set(range(256)) - set(_BASE64_ALPHABET)))
+
+
+def read_image_body(rfile, length, content_type=None):
+    """Read an /image body and return the image file bytes.
+
+    Raw bodies are read as-is. Base64 bodies are decoded chunk by chunk as
+    they arrive, so the encoded text is never held in memory all at once.
+    """
+    media_type = (content_type or "").split(";", 1)[0].strip().lower()
+    if media_type.startswith(RAW_IMAGE_CONTENT_TYPES):
+        return rfile.read(length)
+
+    decoded = io.BytesIO()
+    pending = b""
+    remaining = length
+    first = True
+    while remaining > 0:
+        chunk = rfile.read(min(IMAGE_READ_CHUNK, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        # Accept data URIs ("data:image/png;base64,...") as well as bare base64.
+        if first and chunk[:5].lower() == b"data:":
+            chunk = chunk.partition(b",")[2]
+        first = False
+        # Drop whitespace/newlines so every decode call sees whole 4-char quanta.
+        pending += chunk.translate(None, _BASE64_JUNK)
+        usable = len(pending) - len(pending) % 4
+        decoded.write(binascii.a2b_base64(pending[:usable]))
+        pending = pending[usable:]
+    if pending:
+        decoded.write(binascii.a2b_base64(pending))
+    return decoded.getvalue()
+
+
 class PrinterWriteError(Exception):
     def __init__(self, code, message, status=503, **details):
         super().__init__(message)
@@ -218,83 +282,138 @@ class PrinterWriteError(Exception):
         return payload
 
 
-def trim_top_whitespace(img):
-    """Optionally trim blank rows by shifting content up while preserving canvas size."""
-    if not AUTO_TRIM_TOP_WHITESPACE:
-        return img
+class ImageTooLargeError(ValueError):
+    def __init__(self, width=None, height=None, message=None):
+        if message is None:
+            message = f"Image too large: {width}x{height} exceeds {MAX_IMAGE_PIXELS} pixels"
+        super().__init__(message)
+        self.width = width
+        self.height = height
 
-    mask = img.point(lambda p: 255 if p < WHITE_THRESHOLD else 0, "1")
-    bbox = mask.getbbox()
-    if not bbox:
-        return img
 
-    top = bbox[1]
-    if top <= 0:
-        return img
+def top_whitespace_px(img):
+    """Return how many blank top rows to trim when auto-trim is enabled."""
+    if not AUTO_TRIM_TOP_WHITESPACE or MAX_TOP_TRIM_PX <= 0:
+        return 0
 
-    trim_px = min(top, MAX_TOP_TRIM_PX)
+    # Only the top MAX_TOP_TRIM_PX rows can ever be trimmed, so scan just that
+    # strip; a blank strip means trimming the full amount unless the whole
+    # image is blank.
     width, height = img.size
-    if trim_px >= height:
-        return img
+    strip = img.crop((0, 0, width, min(MAX_TOP_TRIM_PX, height)))
+    mask = strip.point(CONTENT_MASK_LUT, "1")
+    bbox = mask.getbbox()
+    if not bbox and img.getextrema()[0] >= WHITE_THRESHOLD:
+        return 0
 
-    shifted = Image.new("L", (width, height), 255)
-    source = img.crop((0, trim_px, width, height))
-    shifted.paste(source, (0, 0))
-    return shifted
+    trim_px = bbox[1] if bbox else strip.height
+    if trim_px >= height:
+        return 0
+    return trim_px
 
 
-def shift_image_horizontally(img, shift_px):
-    """Shift image content left/right while keeping canvas size constant."""
-    if shift_px == 0:
+def offset_image(img, dx, dy):
+    """Move image content by (dx, dy) on a white canvas of the same size."""
+    if dx == 0 and dy == 0:
         return img
 
-    width, height = img.size
-    if abs(shift_px) >= width:
-        return Image.new("L", (width, height), 255)
+    # paste() clips at the canvas edge, so no intermediate crop is needed.
+    shifted = Image.new("L", img.size, 255)
+    shifted.paste(img, (dx, dy))
+    return shifted
 
-    shifted = Image.new("L", (width, height), 255)
-    if shift_px > 0:
-        source = img.crop((0, 0, width - shift_px, height))
-        shifted.paste(source, (shift_px, 0))
-    else:
-        shift_left = -shift_px
-        source = img.crop((shift_left, 0, width, height))
-        shifted.paste(source, (0, 0))
 
-    return shifted
+def is_black_and_white(img):
+    """True if a grayscale image only contains pure black and/or white pixels."""
+    colors = img.getcolors(2)
+    return colors is not None and all(value in (0, 255) for _, value in colors)
 
 
 def image_to_tspl(image_data, x=X_OFFSET, y=Y_OFFSET, dither=True):
     """Convert image to TSPL BITMAP command with raw binary data."""
-    img = Image.open(io.BytesIO(image_data)).convert("L")
-    img = trim_top_whitespace(img)
-    img = shift_image_horizontally(img, HORIZONTAL_SHIFT_PX)
+    try:
+        img = Image.open(io.BytesIO(image_data))
+    except Image.DecompressionBombError as exc:
+        # Pillow refuses headers past 2x Image.MAX_IMAGE_PIXELS in open(), before
+        # our own limit is checked; report it the same way.
+        raise ImageTooLargeError(message=f"Image too large: {exc}") from exc
+    label_dots = (LABEL_WIDTH_DOTS, LABEL_HEIGHT_DOTS)
+    # JPEG can decode straight to grayscale (and at a reduced scale for large
+    # photos), skipping the RGB -> L pass.
+    img.draft("L", label_dots)
+    # Checked against the (drafted) decode size before any pixel is decoded.
+    if MAX_IMAGE_PIXELS > 0 and img.width * img.height > MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(img.width, img.height)
+    img = img.convert("L")
+    # Wider than the label means it was rendered above printer resolution; fit
+    # it so trim/dither cost follows the label, not the upload. Anything that
+    # fits the width (e.g. a 203 dpi CUPS render of a longer page) prints 1:1,
+    # since resampling would turn crisp barcode bars into dithered gray.
+    if img.width > LABEL_WIDTH_DOTS:
+        img.thumbnail(label_dots, Image.Resampling.LANCZOS)
+    # Top trim and horizontal shift land on one canvas in a single paste.
+    img = offset_image(img, HORIZONTAL_SHIFT_PX, -top_whitespace_px(img))
 
     width, height = img.size
-    img = Image.eval(img, lambda p: 255 - p)
+
+    if dither and is_black_and_white(img):
+        # Error diffusion never fires on pure 0/255 input, so thresholding
+        # gives the same bits without the serial dither pass.
+        dither = False
 
     if dither:
         img = img.convert("1", dither=Image.Dither.FLOYDSTEINBERG)
     else:
-        img = img.point(lambda p: 0 if p < 128 else 255, "1")
+        img = img.point(THRESHOLD_LUT, "1")
 
+    # Mode "1" is stored MSB-first with rows padded to a whole byte, which is
+    # the TSPL BITMAP layout: set bits are white, clear bits print.
     width_bytes = (width + 7) // 8
-    padded_width = width_bytes * 8
-    pixels = list(img.getdata())
-
-    bitmap_bytes = bytearray()
-    for row in range(height):
-        row_start = row * width
-        for byte_col in range(0, padded_width, 8):
-            byte_val = 0
-            for bit in range(8):
-                pixel_col = byte_col + bit
-                if pixel_col < width and pixels[row_start + pixel_col] < 128:
-                    byte_val |= 1 << (7 - bit)
-            bitmap_bytes.append(byte_val)
+    bitmap_bytes = img.tobytes("raw", "1")
 
     header = f"BITMAP {x},{y},{width_bytes},{height},0,"
-    return header, bytes(bitmap_bytes)
+    return header, bitmap_bytes
+
+
+# Static leading block of each text template, rendered with a single %
+# substitution per label instead of one formatted list entry per line.
+TSPL_LABEL_PRELUDE = f"SIZE {LABEL_WIDTH_MM}mm,{LABEL_HEIGHT_MM}mm\nGAP 3mm,0mm\nCLS"
+
+_SHIPPING_HEAD = (
+    TSPL_LABEL_PRELUDE + "\n"
+    "BOX 40,20,400,100,4\n"
+    'TEXT 50,35,"3",0,1,1,"ATK FABRICATION CO."\n'
+    'TEXT 50,75,"1",0,1,1,"Quality Fabrication & Design"\n'
+    "BAR 40,110,360,3\n"
+    'TEXT 50,130,"2",0,1,1,"Order: #%s"\n'
+    'TEXT 50,180,"2",0,1,1,"Date: %s"\n'
+    "BAR 40,230,360,2\n"
+    'TEXT 50,250,"2",0,1,1,"SHIP TO:"\n'
+    'TEXT 70,300,"2",0,1,1,""'
+)
+
+_SIMPLE_HEAD = (
+    TSPL_LABEL_PRELUDE + "\n"
+    'TEXT 50,30,"3",0,1,1,"%s"\n'
+    "BAR 50,80,400,4"
+)
+
+_PACKING_HEAD = (
+    TSPL_LABEL_PRELUDE + "\n"
+    'TEXT 50,30,"3",0,1,1,"PACKING LIST"\n'
+    'TEXT 50,90,"2",0,1,1,"Order: #%s"\n'
+    'TEXT 50,140,"2",0,1,1,"Customer: %s"\n'
+    "BAR 50,190,400,3\n"
+    'TEXT 50,210,"2",0,1,1,"ITEMS:"'
+)
+
+# Escapes user text for a TSPL quoted string. Apply after truncating so an
+# escape sequence is never cut in half.
+_TSPL_ESCAPE = str.maketrans({'"': '\\"', "\\": "\\\\"})
+
+# /image jobs wrap the BITMAP command in these constant bytes.
+IMAGE_JOB_PRELUDE = (TSPL_LABEL_PRELUDE + "\n").encode()
+IMAGE_JOB_EPILOGUE = b"\nPRINT 1,1\n"
 
 
 class LabelTemplates:
@@ -303,20 +422,7 @@ class LabelTemplates:
         if date_str is None:
             date_str = datetime.now().strftime("%Y-%m-%d")
 
-        tspl = [
-            f"SIZE {LABEL_WIDTH_MM}mm,{LABEL_HEIGHT_MM}mm",
-            "GAP 3mm,0mm",
-            "CLS",
-            "BOX 40,20,400,100,4",
-            'TEXT 50,35,"3",0,1,1,"ATK FABRICATION CO."',
-            'TEXT 50,75,"1",0,1,1,"Quality Fabrication & Design"',
-            "BAR 40,110,360,3",
-            f'TEXT 50,130,"2",0,1,1,"Order: #{order}"',
-            f'TEXT 50,180,"2",0,1,1,"Date: {date_str}"',
-            "BAR 40,230,360,2",
-            'TEXT 50,250,"2",0,1,1,"SHIP TO:"',
-            'TEXT 70,300,"2",0,1,1,""',
-        ]
+        tspl = [_SHIPPING_HEAD % (order, date_str)]
 
         if "," in address:
             addr_lines = address.split(",")
@@ -324,7 +430,7 @@ class LabelTemplates:
             addr_lines = [address[i:i + 30] for i in range(0, min(len(address), 90), 30)]
         y = 330
         for line in addr_lines[:3]:
-            safe_line = line.strip().replace('"', '\\"')[:35]
+            safe_line = line.strip()[:35].translate(_TSPL_ESCAPE)
             tspl.append(f'TEXT 70,{y},"2",0,1,1,"{safe_line}"')
             y += 50
 
@@ -342,16 +448,10 @@ class LabelTemplates:
 
     @staticmethod
     def simple_text(lines, title="ATK FABRICATION"):
-        tspl = [
-            f"SIZE {LABEL_WIDTH_MM}mm,{LABEL_HEIGHT_MM}mm",
-            "GAP 3mm,0mm",
-            "CLS",
-            f'TEXT 50,30,"3",0,1,1,"{title}"',
-            "BAR 50,80,400,4",
-        ]
+        tspl = [_SIMPLE_HEAD % title]
         y = 110
         for line in lines[:8]:
-            safe = line.replace('"', '\\"')[:40]
+            safe = line[:40].translate(_TSPL_ESCAPE)
             tspl.append(f'TEXT 50,{y},"2",0,1,1,"{safe}"')
             y += 55
         tspl.append("PRINT 1,1")
@@ -359,26 +459,119 @@ class LabelTemplates:
 
     @staticmethod
     def packing_list(order, items, customer):
-        tspl = [
-            f"SIZE {LABEL_WIDTH_MM}mm,{LABEL_HEIGHT_MM}mm",
-            "GAP 3mm,0mm",
-            "CLS",
-            'TEXT 50,30,"3",0,1,1,"PACKING LIST"',
-            f'TEXT 50,90,"2",0,1,1,"Order: #{order}"',
-            f'TEXT 50,140,"2",0,1,1,"Customer: {customer[:30]}"',
-            "BAR 50,190,400,3",
-            'TEXT 50,210,"2",0,1,1,"ITEMS:"',
-        ]
+        tspl = [_PACKING_HEAD % (order, customer[:30])]
         y = 260
         for i, item in enumerate(items[:6], 1):
-            safe = item.replace('"', '\\"')[:35]
+            safe = item[:35].translate(_TSPL_ESCAPE)
             tspl.append(f'TEXT 70,{y},"2",0,1,1,"{i}. {safe}"')
             y += 50
         tspl.append("PRINT 1,1")
         return "\n".join(tspl)
 
 
-def _write_printer(payload):
+# The printer is a single-writer device: concurrent jobs from the threaded
+# server must not interleave their bytes.
+_printer_lock = threading.Lock()
+_printer_fd = None
+_printer_fd_path = None
+
+# Errors from a cached fd whose device went away (unplug/replug, reset).
+_STALE_FD_ERRNOS = {errno.EBADF, errno.EIO, errno.ENODEV, errno.ENXIO}
+
+
+def _write_all(fd, parts):
+    """Gather-write every buffer in parts, resuming after short writes.
+
+    Each writev() carries at most PRINTER_WRITE_CHUNK bytes so the USB printer
+    sees predictably sized transfers; memoryview slices avoid copying. An
+    OSError is re-raised with the bytes already sent as exc.bytes_written.
+    """
+    views = [memoryview(part) for part in parts if part]
+    sent = 0
+    while views:
+        if PRINTER_WRITE_CHUNK > 0:
+            batch = []
+            room = PRINTER_WRITE_CHUNK
+            for view in views:
+                batch.append(view[:room])
+                room -= len(batch[-1])
+                if room <= 0:
+                    break
+        else:
+            batch = views
+        try:
+            written = os.writev(fd, batch)
+        except OSError as exc:
+            exc.bytes_written = sent
+            raise
+        sent += written
+        while views and written >= len(views[0]):
+            written -= len(views.pop(0))
+        if written:
+            views[0] = views[0][written:]
+
+
+def _close_printer_fd():
+    global _printer_fd, _printer_fd_path
+    if _printer_fd is not None:
+        try:
+            os.close(_printer_fd)
+        except OSError:
+            pass
+    _printer_fd = None
+    _printer_fd_path = None
+
+
+def _open_printer_fd(device_path):
+    """Return a writable fd for device_path, reusing the cached one if possible.
+
+    Must be called with _printer_lock held. Returns (fd, reused).
+    """
+    global _printer_fd, _printer_fd_path
+    if _printer_fd is not None and _printer_fd_path == device_path:
+        return _printer_fd, True
+    _close_printer_fd()
+    fd = os.open(device_path, os.O_WRONLY | os.O_CLOEXEC)
+    if KEEP_DEVICE_OPEN:
+        _printer_fd = fd
+        _printer_fd_path = device_path
+    return fd, False
+
+
+def _write_device(device_path, parts):
+    if not _printer_lock.acquire(timeout=PRINTER_BUSY_TIMEOUT if PRINTER_BUSY_TIMEOUT > 0 else -1):
+        raise PrinterWriteError(
+            "printer_busy",
+            "Printer is busy with another job",
+            status=503,
+            device_path=device_path,
+            timeout_s=PRINTER_BUSY_TIMEOUT,
+        )
+    try:
+        fd, reused = _open_printer_fd(device_path)
+        try:
+            _write_all(fd, parts)
+        except OSError as exc:
+            _close_printer_fd()
+            if not (reused and exc.errno in _STALE_FD_ERRNOS) or exc.bytes_written:
+                raise
+            # The cached fd outlived its device; retry once on a fresh open.
+            # Only safe when nothing was sent, or the printer would get a
+            # truncated job followed by the full one.
+            fd, _ = _open_printer_fd(device_path)
+            try:
+                _write_all(fd, parts)
+            except OSError:
+                _close_printer_fd()
+                raise
+        finally:
+            if not KEEP_DEVICE_OPEN:
+                os.close(fd)
+    finally:
+        _printer_lock.release()
+
+
+def _write_printer(parts):
     device_path = current_printer_device()
     if not device_path:
         raise PrinterWriteError(
@@ -389,8 +582,7 @@ def _write_printer(payload):
         )
 
     try:
-        with open(device_path, "wb") as device:
-            device.write(payload)
+        _write_device(device_path, parts)
         return device_path
     except FileNotFoundError as exc:
         raise PrinterWriteError(
@@ -418,11 +610,12 @@ def _write_printer(payload):
 
 
 def send_tspl(tspl_data):
-    return _write_printer((tspl_data + "\n").encode())
+    return _write_printer([tspl_data.encode(), b"\n"])
 
 
-def send_tspl_bytes(tspl_bytes):
-    return _write_printer(tspl_bytes)
+def send_tspl_parts(parts):
+    """Send several TSPL byte chunks as one job without concatenating them."""
+    return _write_printer(parts)
 
 
 def help_text():
@@ -440,19 +633,75 @@ POST /print       - Simple text (body: "Line 1\\nLine 2")
 POST /shipping    - Shipping label (body: "order|customer|address|barcode")
 POST /packing     - Packing list (body: "order|customer|item1,item2,item3")
 POST /raw         - Raw TSPL commands
-POST /image       - Base64-encoded PNG/JPG image
+POST /image       - PNG/JPG image (raw with Content-Type: image/*, otherwise base64;
+                    add ?dither=0 to threshold instead of dithering)
 
 EXAMPLES:
 curl -X POST http://thermal.local:8765/shipping -d "54321|Jane Doe|123 Oak Ave, Detroit|ORDER54321"
 curl -X POST http://thermal.local:8765/image -d "$(base64 -i logo.png)"
+curl -X POST http://thermal.local:8765/image -H "Content-Type: image/png" --data-binary @logo.png
 curl -X POST http://thermal.local:8765/rewind -d '{"labels":2}'
 """
 
 
+class StaticResponse:
+    """A response body that never changes for the life of the process."""
+
+    def __init__(self, text, content_type="text/plain"):
+        self.content_type = content_type
+        self.body = text.encode()
+        self.gzip_body = gzip.compress(self.body, compresslevel=9)
+        self.etag = '"%s"' % hashlib.blake2b(self.body, digest_size=8).hexdigest()
+
+
+def accepts_gzip(accept_encoding):
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.partition(";")
+        if coding.strip().lower() not in {"gzip", "*"}:
+            continue
+        quality = params.strip().lower()
+        if quality.startswith("q="):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+HELP_RESPONSE = StaticResponse(help_text())
+
+
+# Image decode/dither is the memory- and CPU-heavy part of a request; bound
+# how many run at once independently of how many connections are open.
+_image_slots = threading.BoundedSemaphore(IMAGE_WORKERS)
+
+
 class Handler(http.server.SimpleHTTPRequestHandler):
+    # Idle or stalled clients would otherwise hold a connection slot indefinitely.
+    timeout = HTTP_TIMEOUT if HTTP_TIMEOUT > 0 else None
+
+    # Every POST route and its handler method. do_POST dispatches from this
+    # table only and answers anything else with 404 before reading the body.
+    POST_ROUTES = {
+        "/print": "_post_print",
+        "/shipping": "_post_shipping",
+        "/packing": "_post_packing",
+        "/raw": "_post_raw",
+        "/rewind": "_post_rewind",
+        "/image": "_post_image",
+    }
+    # Routes whose handler reads the request body from rfile itself.
+    STREAMED_POST_ROUTES = frozenset({"/image"})
+
     def log_message(self, fmt, *args):
         log_event("info", "http_request", client=self.client_address[0], path=self.path, detail=(fmt % args))
 
+    def log_request(self, code="-", size="-"):
+        # Successful requests are only logged on demand; errors always are.
+        if LOG_REQUESTS or (isinstance(code, int) and code >= 400):
+            super().log_request(code, size)
+
     def send_json(self, data, code=200):
         payload = json.dumps(data).encode()
         self.send_response(code)
@@ -461,11 +710,25 @@ class Handler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(payload)
 
-    def send_text(self, text, code=200):
-        payload = text.encode()
-        self.send_response(code)
-        self.send_header("Content-type", "text/plain")
+    def send_static(self, response):
+        """Send a StaticResponse, honouring If-None-Match and gzip."""
+        if_none_match = self.headers.get("If-None-Match", "")
+        if response.etag in {tag.strip() for tag in if_none_match.split(",")} or if_none_match.strip() == "*":
+            self.send_response(304)
+            self.send_header("ETag", response.etag)
+            self.end_headers()
+            return
+
+        use_gzip = accepts_gzip(self.headers.get("Accept-Encoding"))
+        payload = response.gzip_body if use_gzip else response.body
+        self.send_response(200)
+        self.send_header("Content-type", response.content_type)
         self.send_header("Content-Length", str(len(payload)))
+        self.send_header("ETag", response.etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
         self.end_headers()
         self.wfile.write(payload)
 
@@ -490,109 +753,24 @@ class Handler(http.server.SimpleHTTPRequestHandler):
 
     def do_POST(self):
         route = urlparse(self.path).path
-        content_len = int(self.headers.get("Content-Length", 0))
-        body = self.rfile.read(content_len)
-
-        try:
-            if route == "/print":
-                def do_print():
-                    lines = self._decode_body_text(body).strip().split("\n")
-                    device_path = send_tspl(LabelTemplates.simple_text(lines))
-                    self.send_json({"status": "printed", "lines": len(lines), "template": "simple", "device_path": device_path})
-                self._with_eyes(do_print)
-                return
-
-            if route == "/shipping":
-                def do_shipping():
-                    parts = self._decode_body_text(body).strip().split("|")
-                    if len(parts) < 3:
-                        self.send_json({"error": "Format: order|customer|address|barcode", "code": "bad_request"}, 400)
-                        return
-                    order, customer, address = parts[0], parts[1], parts[2]
-                    barcode = parts[3] if len(parts) > 3 else order
-                    device_path = send_tspl(LabelTemplates.standard_shipping(order, customer, address, barcode))
-                    self.send_json({"status": "printed", "order": order, "template": "shipping", "device_path": device_path})
-                self._with_eyes(do_shipping)
-                return
-
-            if route == "/packing":
-                def do_packing():
-                    parts = self._decode_body_text(body).strip().split("|")
-                    if len(parts) < 3:
-                        self.send_json({"error": "Format: order|customer|item1,item2,item3", "code": "bad_request"}, 400)
-                        return
-                    order, customer = parts[0], parts[1]
-                    items = parts[2].split(",")
-                    device_path = send_tspl(LabelTemplates.packing_list(order, items, customer))
-                    self.send_json(
-                        {"status": "printed", "order": order, "template": "packing", "items": len(items), "device_path": device_path}
-                    )
-                self._with_eyes(do_packing)
-                return
-
-            if route == "/raw":
-                def do_raw():
-                    device_path = send_tspl(self._decode_body_text(body))
-                    self.send_json({"status": "printed", "mode": "raw", "device_path": device_path})
-                self._with_eyes(do_raw)
-                return
-
-            if route == "/rewind":
-                req = parse_rewind_request(self.path, body)
-                tspl = f"BACKFEED {req['dots']}"
-                device_path = None
-                if not req["dry_run"]:
-                    # 30% chance to do a suspicious sweep during rewind
-                    if eyes and random.random() < 0.3:
-                        eyes.sweep()
-                    elif eyes:
-                        eyes.focus()
-                    try:
-                        device_path = send_tspl(tspl)
-                    finally:
-                        if eyes:
-                            eyes.sleep()
-                self.send_json(
-                    {
-                        "status": "ok" if req["dry_run"] else "printed",
-                        "mode": "rewind",
-                        "labels": req["labels"],
-                        "dots": req["dots"],
-                        "pitch_mm": req["pitch_mm"],
-                        "dpi": req["dpi"],
-                        "tspl": tspl,
-                        "dry_run": req["dry_run"],
-                        "device_path": device_path,
-                    }
-                )
-                return
-
-            if route == "/image":
-                def do_image():
-                    try:
-                        image_data = base64.b64decode(body, validate=False)
-                        header, bitmap_data = image_to_tspl(image_data)
-                        output = bytearray()
-                        output.extend(f"SIZE {LABEL_WIDTH_MM}mm,{LABEL_HEIGHT_MM}mm\n".encode())
-                        output.extend(b"GAP 3mm,0mm\n")
-                        output.extend(b"CLS\n")
-                        output.extend(header.encode("ascii"))
-                        output.extend(bitmap_data)
-                        output.extend(b"\nPRINT 1,1\n")
-                        device_path = send_tspl_bytes(output)
-                        self.send_json({"status": "printed", "template": "image", "device_path": device_path})
-                    except PrinterWriteError:
-                        raise
-                    except Exception as exc:
-                        self.send_json(
-                            {"error": f"Image processing failed: {exc}", "code": "image_processing_failed"},
-                            500,
-                        )
-                self._with_eyes(do_image)
-                return
-
+        self.content_length = int(self.headers.get("Content-Length", 0))
+        handler = self.POST_ROUTES.get(route)
+        if handler is None:
+            # Drain the body first: closing with unread data makes the kernel
+            # reset the connection and the client never sees the 404.
+            remaining = self.content_length
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, IMAGE_READ_CHUNK))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
             self.send_error(404)
+            return
+        # Streamed routes read their (possibly large) body themselves.
+        body = None if route in self.STREAMED_POST_ROUTES else self.rfile.read(self.content_length)
 
+        try:
+            getattr(self, handler)(body)
         except PrinterWriteError as exc:
             if eyes:
                 eyes.surprise()
@@ -612,6 +790,102 @@ class Handler(http.server.SimpleHTTPRequestHandler):
                 time.sleep(1)
                 eyes.sleep()
 
+    def _post_print(self, body):
+        def do_print():
+            lines = self._decode_body_text(body).strip().splitlines()
+            device_path = send_tspl(LabelTemplates.simple_text(lines))
+            self.send_json({"status": "printed", "lines": len(lines), "template": "simple", "device_path": device_path})
+        self._with_eyes(do_print)
+
+    def _post_shipping(self, body):
+        def do_shipping():
+            parts = self._decode_body_text(body).strip().split("|")
+            if len(parts) < 3:
+                self.send_json({"error": "Format: order|customer|address|barcode", "code": "bad_request"}, 400)
+                return
+            order, customer, address = parts[0], parts[1], parts[2]
+            barcode = parts[3] if len(parts) > 3 else order
+            device_path = send_tspl(LabelTemplates.standard_shipping(order, customer, address, barcode))
+            self.send_json({"status": "printed", "order": order, "template": "shipping", "device_path": device_path})
+        self._with_eyes(do_shipping)
+
+    def _post_packing(self, body):
+        def do_packing():
+            parts = self._decode_body_text(body).strip().split("|")
+            if len(parts) < 3:
+                self.send_json({"error": "Format: order|customer|item1,item2,item3", "code": "bad_request"}, 400)
+                return
+            order, customer = parts[0], parts[1]
+            items = parts[2].split(",")
+            device_path = send_tspl(LabelTemplates.packing_list(order, items, customer))
+            self.send_json(
+                {"status": "printed", "order": order, "template": "packing", "items": len(items), "device_path": device_path}
+            )
+        self._with_eyes(do_packing)
+
+    def _post_raw(self, body):
+        def do_raw():
+            device_path = send_tspl(self._decode_body_text(body))
+            self.send_json({"status": "printed", "mode": "raw", "device_path": device_path})
+        self._with_eyes(do_raw)
+
+    def _post_rewind(self, body):
+        req = parse_rewind_request(self.path, body)
+        tspl = f"BACKFEED {req['dots']}"
+        device_path = None
+        if not req["dry_run"]:
+            # 30% chance to do a suspicious sweep during rewind
+            if eyes and random.random() < 0.3:
+                eyes.sweep()
+            elif eyes:
+                eyes.focus()
+            try:
+                device_path = send_tspl(tspl)
+            finally:
+                if eyes:
+                    eyes.sleep()
+        self.send_json(
+            {
+                "status": "ok" if req["dry_run"] else "printed",
+                "mode": "rewind",
+                "labels": req["labels"],
+                "dots": req["dots"],
+                "pitch_mm": req["pitch_mm"],
+                "dpi": req["dpi"],
+                "tspl": tspl,
+                "dry_run": req["dry_run"],
+                "device_path": device_path,
+            }
+        )
+
+    def _post_image(self, body):
+        def do_image():
+            try:
+                image_data = read_image_body(self.rfile, self.content_length, self.headers.get("Content-Type"))
+                query = parse_qs(urlparse(self.path).query)
+                dither = True
+                if "dither" in query:
+                    dither = query["dither"][-1].strip().lower() in {"1", "true", "yes", "on"}
+                with _image_slots:
+                    header, bitmap_data = image_to_tspl(image_data, dither=dither)
+                device_path = send_tspl_parts(
+                    [IMAGE_JOB_PRELUDE, header.encode("ascii"), bitmap_data, IMAGE_JOB_EPILOGUE]
+                )
+                self.send_json({"status": "printed", "template": "image", "device_path": device_path})
+            except PrinterWriteError:
+                raise
+            except ImageTooLargeError as exc:
+                self.send_json(
+                    {"error": str(exc), "code": "image_too_large", "width": exc.width, "height": exc.height},
+                    413,
+                )
+            except Exception as exc:
+                self.send_json(
+                    {"error": f"Image processing failed: {exc}", "code": "image_processing_failed"},
+                    500,
+                )
+        self._with_eyes(do_image)
+
     def do_GET(self):
         route = urlparse(self.path).path
         if route == "/healthz":
@@ -621,16 +895,56 @@ class Handler(http.server.SimpleHTTPRequestHandler):
             return
 
         if route == "/":
-            self.send_text(help_text(), 200)
+            self.send_static(HELP_RESPONSE)
             return
 
         self.send_error(404)
 
 
+SERVER_BUSY_BODY = json.dumps({"error": "Too many open connections", "code": "server_busy"}).encode()
+SERVER_BUSY_RESPONSE = (
+    b"HTTP/1.0 503 Service Unavailable\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Content-Length: %d\r\n"
+    b"Connection: close\r\n\r\n" % len(SERVER_BUSY_BODY)
+) + SERVER_BUSY_BODY
+
+
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Thread per connection, with at most MAX_CONNECTIONS open at once.
+
+    Requests must not share a fixed pool: a print job can block for as long
+    as the printer does, and /healthz has to stay answerable meanwhile.
+    Connections over the cap get an immediate 503 instead of queueing.
+    """
+
     daemon_threads = True
     allow_reuse_address = True
 
+    def __init__(self, server_address, handler_class):
+        super().__init__(server_address, handler_class)
+        self._slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            try:
+                request.sendall(SERVER_BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
+
 
 if __name__ == "__main__":
     with ThreadedTCPServer(("0.0.0.0", PORT), Handler) as httpd:
@@ -638,6 +952,9 @@ if __name__ == "__main__":
             "info",
             "server_start",
             port=PORT,
+            max_connections=MAX_CONNECTIONS,
+            image_workers=IMAGE_WORKERS,
+            http_timeout=HTTP_TIMEOUT,
             label_width_mm=LABEL_WIDTH_MM,
             label_height_mm=LABEL_HEIGHT_MM,
             device_candidates=PRINTER_DEVICE_CANDIDATES,